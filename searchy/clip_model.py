@@ -1,18 +1,15 @@
 import torch
-from transformers import CLIPProcessor, CLIPModel
+from similarity_search import get_model_and_processor, get_device
 
-try:
-    model = CLIPModel.from_pretrained("openai/clip-vit-base-patch32")
-    processor = CLIPProcessor.from_pretrained("openai/clip-vit-base-patch32")
-except Exception as e:
-    print(f"Error loading CLIP model: {e}")
-    raise SystemExit
+# The CLIP model is shared with similarity_search and only loaded on first use
 
 def generate_image_embedding(image):
     try:
+        model, processor = get_model_and_processor()
         inputs = processor(images=image, return_tensors="pt")
-        with torch.no_grad():
-            image_embedding = model.get_image_features(**inputs).cpu().numpy().flatten()
+        pixel_values = inputs["pixel_values"].to(get_device(), dtype=model.dtype)
+        with torch.inference_mode():
+            image_embedding = model.get_image_features(pixel_values=pixel_values).float().cpu().numpy().flatten()
         print(f"Image Embedding Shape: {image_embedding.shape}")
         return image_embedding
     except Exception as e:
@@ -21,9 +18,11 @@ def generate_image_embedding(image):
 
 def generate_text_embedding(query_text):
     try:
+        model, processor = get_model_and_processor()
         inputs = processor(text=query_text, return_tensors="pt")
-        with torch.no_grad():
-            text_embedding = model.get_text_features(**inputs).cpu().numpy().flatten()
+        inputs = {k: v.to(get_device()) for k, v in inputs.items()}
+        with torch.inference_mode():
+            text_embedding = model.get_text_features(**inputs).float().cpu().numpy().flatten()
         print(f"Text Embedding Shape: {text_embedding.shape}")
         return text_embedding
     except Exception as e:
@@ -1,69 +1,391 @@
 import pickle
+import struct
 import numpy as np
-from sklearn.metrics.pairwise import cosine_similarity
 import os
 import sys
 import json
 
-def save_embeddings(embeddings, image_paths, data_dir):
+try:
+    import faiss
+except ImportError:
+    faiss = None
+
+EMBEDDINGS_FILE = 'image_embeddings.bin'
+PATHS_FILE = 'image_paths.jsonl'
+LEGACY_INDEX_FILE = 'image_index.bin'
+FAISS_INDEX_FILE = 'image_index.faiss'
+SETTINGS_FILE = 'index_settings.json'
+# Indexing options stored with the index so later runs keep (or migrate) them
+DEFAULT_INDEX_SETTINGS = {"tile_large_images": False}
+# Unit vectors are stored as symmetric int8 (component * 127): 4x smaller than fp32
+# with negligible effect on ranking
+EMBEDDING_DTYPE = np.int8
+QUANTIZATION_SCALE = 127.0
+# Below this size exact brute-force search over the int8 matrix is already fast;
+# from this size on a FAISS HNSW index is kept alongside it when faiss is installed
+HNSW_MIN_SIZE = 50000
+# Brute-force search dequantizes this many rows at a time (~16 MB of fp32 at 512 dims)
+SEARCH_BLOCK_ROWS = 8192
+# Rows sampled to train the FAISS scalar quantizer
+FAISS_TRAIN_ROWS = 65536
+# Tiles of large images are extra rows that share their source image's path;
+# the paths file marks them as {"path": ..., "tile": true}
+MAX_TILES_PER_IMAGE = 6
+
+# Fixed-size header: magic, format version, row count, dimension, dtype code,
+# and the committed byte length of the paths file
+HEADER_FORMAT = '<8sIQI4sQ4x'
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+HEADER_MAGIC = b'SEARCHY\0'
+HEADER_VERSION = 1
+
+def _pack_header(count, dim, dtype, paths_size):
+    return struct.pack(HEADER_FORMAT, HEADER_MAGIC, HEADER_VERSION, count, dim,
+                       np.dtype(dtype).str[1:].encode(), paths_size)
+
+def _read_header(f):
+    magic, version, count, dim, dtype_code, paths_size = struct.unpack(HEADER_FORMAT, f.read(HEADER_SIZE))
+    if magic != HEADER_MAGIC or version != HEADER_VERSION:
+        raise ValueError("Invalid data format in embeddings file")
+    return count, dim, np.dtype(dtype_code.rstrip(b'\0').decode()), paths_size
+
+def _encode_paths(image_paths, is_tile=None):
+    if is_tile is None:
+        is_tile = [False] * len(image_paths)
+    return ''.join(json.dumps({"path": path, "tile": True} if tile else path) + '\n'
+                   for path, tile in zip(image_paths, is_tile)).encode()
+
+def _decode_paths(data):
+    lines = data.splitlines()
+    image_paths = []
+    is_tile = np.zeros(len(lines), dtype=bool)
+    for row, line in enumerate(lines):
+        entry = json.loads(line)
+        if isinstance(entry, dict):
+            is_tile[row] = entry.get("tile", False)
+            entry = entry["path"]
+        image_paths.append(entry)
+    return image_paths, is_tile
+
+def quantize_embeddings(embeddings, dtype=EMBEDDING_DTYPE):
+    """
+    Convert unit-normalized float embeddings to the on-disk dtype.
+    """
+    dtype = np.dtype(dtype)
+    if dtype == np.int8:
+        scaled = np.rint(np.asarray(embeddings, dtype=np.float32) * QUANTIZATION_SCALE)
+        return np.ascontiguousarray(np.clip(scaled, -127, 127), dtype=np.int8)
+    return np.ascontiguousarray(embeddings, dtype=dtype)
+
+def dequantize_embeddings(embeddings):
+    """
+    Float32 view of stored embeddings, undoing int8 quantization if needed.
+    """
+    if embeddings.dtype == np.int8:
+        return embeddings.astype(np.float32) * np.float32(1.0 / QUANTIZATION_SCALE)
+    return np.asarray(embeddings, dtype=np.float32)
+
+def save_embeddings(embeddings, image_paths, data_dir, is_tile=None):
+    """
+    Write a complete index, replacing any existing one.
+    is_tile optionally marks rows that are tiles of the image at the same path.
+    """
     try:
-        filename = os.path.join(data_dir, 'image_index.bin')
-        data = {'embeddings': embeddings, 'image_paths': image_paths}
-        with open(filename, 'wb') as f:
-            pickle.dump(data, f)
+        embeddings = quantize_embeddings(embeddings)
+        embeddings_file = os.path.join(data_dir, EMBEDDINGS_FILE)
+        paths_file = os.path.join(data_dir, PATHS_FILE)
+        
+        # Write to temp files and swap in so readers never see a half-written index
+        paths_data = _encode_paths(image_paths, is_tile)
+        with open(paths_file + '.tmp', 'wb') as f:
+            f.write(paths_data)
+        with open(embeddings_file + '.tmp', 'wb') as f:
+            f.write(_pack_header(len(embeddings), embeddings.shape[1], EMBEDDING_DTYPE, len(paths_data)))
+            embeddings.tofile(f)
+        os.replace(paths_file + '.tmp', paths_file)
+        os.replace(embeddings_file + '.tmp', embeddings_file)
+        
+        # Any FAISS index describes the replaced rows; update_faiss_index rebuilds it
+        _remove_faiss_index(data_dir)
         return True
     except Exception as e:
         print(json.dumps({"error": str(e)}))
         return False
 
-def load_embeddings(data_dir):
+def append_embeddings(embeddings, image_paths, data_dir, is_tile=None):
+    """
+    Append rows to an existing index in O(new rows): the new embeddings and paths
+    are written at the end of their files and only the header row count is rewritten.
+    The FAISS index is left behind; call update_faiss_index once after appending.
+    """
     try:
-        filename = os.path.join(data_dir, 'image_index.bin')
+        embeddings_file = os.path.join(data_dir, EMBEDDINGS_FILE)
         
-        if not os.path.exists(filename):
+        with open(embeddings_file, 'r+b') as f:
+            count, dim, dtype, paths_size = _read_header(f)
+            if dim != embeddings.shape[1]:
+                raise ValueError("Embedding shape does not match existing index")
+            # Match whatever dtype the index was created with
+            embeddings = quantize_embeddings(embeddings, dtype)
+            # Writes start at the committed ends, overwriting anything left by an interrupted append
+            f.seek(HEADER_SIZE + count * dim * dtype.itemsize)
+            embeddings.tofile(f)
+            f.truncate()
+            with open(os.path.join(data_dir, PATHS_FILE), 'r+b') as paths_f:
+                paths_f.seek(paths_size)
+                paths_data = _encode_paths(image_paths, is_tile)
+                paths_f.write(paths_data)
+                paths_f.truncate()
+            # The header is updated last so a crash mid-append leaves the old index intact
+            f.flush()
+            f.seek(0)
+            f.write(_pack_header(count + len(embeddings), dim, dtype, paths_size + len(paths_data)))
+        return True
+    except Exception as e:
+        print(json.dumps({"error": str(e)}))
+        return False
+
+def _load_legacy_index(data_dir):
+    with open(os.path.join(data_dir, LEGACY_INDEX_FILE), 'rb') as f:
+        data = pickle.load(f)
+    if not isinstance(data, dict) or 'embeddings' not in data or 'image_paths' not in data:
+        raise ValueError("Invalid data format in embeddings file")
+    image_paths = data['image_paths']
+    return np.asarray(data['embeddings'], dtype=np.float32), image_paths, np.zeros(len(image_paths), dtype=bool)
+
+def index_exists(data_dir):
+    return (os.path.exists(os.path.join(data_dir, EMBEDDINGS_FILE))
+            or os.path.exists(os.path.join(data_dir, LEGACY_INDEX_FILE)))
+
+def is_appendable(data_dir):
+    return os.path.exists(os.path.join(data_dir, EMBEDDINGS_FILE))
+
+def load_index_settings(data_dir):
+    settings = dict(DEFAULT_INDEX_SETTINGS)
+    try:
+        with open(os.path.join(data_dir, SETTINGS_FILE)) as f:
+            settings.update(json.load(f))
+    except FileNotFoundError:
+        pass
+    return settings
+
+def save_index_settings(settings, data_dir):
+    settings_file = os.path.join(data_dir, SETTINGS_FILE)
+    with open(settings_file + '.tmp', 'w') as f:
+        json.dump(settings, f)
+    os.replace(settings_file + '.tmp', settings_file)
+
+def index_version(data_dir):
+    """
+    Cheap fingerprint of the on-disk index that changes whenever rows are appended
+    or any index file is rewritten, so callers can cache what load_index returns.
+    """
+    version = [data_dir]
+    embeddings_file = os.path.join(data_dir, EMBEDDINGS_FILE)
+    if os.path.exists(embeddings_file):
+        with open(embeddings_file, 'rb') as f:
+            version.append(_read_header(f)[0])
+    for name in (EMBEDDINGS_FILE, LEGACY_INDEX_FILE, FAISS_INDEX_FILE):
+        try:
+            version.append(os.stat(os.path.join(data_dir, name)).st_mtime_ns)
+        except OSError:
+            version.append(None)
+    return tuple(version)
+
+def load_index(data_dir):
+    """
+    Memory-map the stored embeddings (read-only) and read the image paths.
+    Returns (embeddings, image_paths, is_tile) where is_tile is a boolean row mask.
+    Falls back to the legacy pickle index written by older versions.
+    """
+    embeddings_file = os.path.join(data_dir, EMBEDDINGS_FILE)
+    if not os.path.exists(embeddings_file):
+        return _load_legacy_index(data_dir)
+    
+    with open(embeddings_file, 'rb') as f:
+        count, dim, dtype, paths_size = _read_header(f)
+    
+    with open(os.path.join(data_dir, PATHS_FILE), 'rb') as f:
+        image_paths, is_tile = _decode_paths(f.read(paths_size))
+    
+    if count == 0:
+        return np.empty((0, dim), dtype=dtype), image_paths, is_tile
+    
+    embeddings = np.memmap(embeddings_file, dtype=dtype, mode='r', offset=HEADER_SIZE, shape=(count, dim))
+    return embeddings, image_paths, is_tile
+
+def load_embeddings(data_dir):
+    """
+    Load the index for search as (embeddings, image_paths, is_tile), creating an empty
+    one if none exists. Pass is_tile on to semantic_search so tile rows collapse.
+    """
+    try:
+        if not index_exists(data_dir):
             # Create empty embeddings file
-            empty_embeddings = np.empty((0, 512))
+            empty_embeddings = np.empty((0, 512), dtype=EMBEDDING_DTYPE)
             empty_image_paths = []
             if not save_embeddings(empty_embeddings, empty_image_paths, data_dir):
                 print(json.dumps({"error": "Failed to create initial embeddings file"}))
-                return None, None
+                return None, None, None
         
-        with open(filename, 'rb') as f:
-            data = pickle.load(f)
-            
-        if not isinstance(data, dict) or 'embeddings' not in data or 'image_paths' not in data:
-            print(json.dumps({"error": "Invalid data format in embeddings file"}))
-            return None, None
-            
-        embeddings = np.array(data['embeddings'])
-        image_paths = data['image_paths']
+        embeddings, image_paths, is_tile = load_index(data_dir)
         
         if embeddings.size == 0 or len(image_paths) == 0:
             print(json.dumps({"error": "No embeddings or image paths found"}))
-            return None, None
+            return None, None, None
             
-        return embeddings, image_paths
+        return embeddings, image_paths, is_tile
         
     except Exception as e:
         print(json.dumps({"error": f"Failed to load embeddings: {str(e)}"}))
-        return None, None
+        return None, None, None
+
+def build_faiss_index(embeddings):
+    """
+    Build an inner-product FAISS HNSW index over unit-normalized embeddings.
+    Vectors are held as 8-bit scalar-quantized codes (IndexHNSWSQ), matching the int8 matrix on disk.
+    There is no flat FAISS tier: smaller indexes are searched by search_embeddings directly.
+    Returns None when faiss is not installed or the index is small enough for brute force.
+    """
+    if faiss is None or len(embeddings) < HNSW_MIN_SIZE:
+        return None
+    index = faiss.IndexHNSWSQ(embeddings.shape[1], faiss.ScalarQuantizer.QT_8bit, 32, faiss.METRIC_INNER_PRODUCT)
+    index.hnsw.efConstruction = 200
+    step = max(1, len(embeddings) // FAISS_TRAIN_ROWS)
+    index.train(np.ascontiguousarray(dequantize_embeddings(embeddings[::step])))
+    _add_to_faiss_index(index, embeddings)
+    return index
+
+def _add_to_faiss_index(index, embeddings):
+    for start in range(0, len(embeddings), SEARCH_BLOCK_ROWS):
+        index.add(np.ascontiguousarray(dequantize_embeddings(embeddings[start:start + SEARCH_BLOCK_ROWS])))
+
+def load_faiss_index(data_dir, expected_size):
+    """
+    Load the persisted FAISS HNSW index, or None if it is unavailable, out of date,
+    or a flat index left by an older version.
+    """
+    faiss_file = os.path.join(data_dir, FAISS_INDEX_FILE)
+    if faiss is None or not os.path.exists(faiss_file):
+        return None
+    index = faiss.read_index(faiss_file)
+    if index.ntotal != expected_size or not hasattr(index, 'hnsw'):
+        return None
+    return index
+
+def _save_faiss_index(faiss_index, data_dir):
+    faiss_file = os.path.join(data_dir, FAISS_INDEX_FILE)
+    faiss.write_index(faiss_index, faiss_file + '.tmp')
+    os.replace(faiss_file + '.tmp', faiss_file)
 
-def semantic_search(query_embedding, embeddings, image_paths, top_k=5):
+def _remove_faiss_index(data_dir):
+    try:
+        os.remove(os.path.join(data_dir, FAISS_INDEX_FILE))
+    except FileNotFoundError:
+        pass
+
+def update_faiss_index(data_dir):
+    """
+    Bring the persisted FAISS index in line with the stored embeddings, adding only
+    the rows it is missing. Unlike append_embeddings this rewrites the whole FAISS
+    file, so indexing calls it once per run rather than per append.
+    """
+    if faiss is None:
+        return
+    try:
+        embeddings, _, _ = load_index(data_dir)
+        if len(embeddings) < HNSW_MIN_SIZE:
+            _remove_faiss_index(data_dir)
+            return
+        faiss_file = os.path.join(data_dir, FAISS_INDEX_FILE)
+        faiss_index = faiss.read_index(faiss_file) if os.path.exists(faiss_file) else None
+        # Rows are append-only, so a smaller index covers a prefix of the matrix.
+        # Files from older versions may hold a flat fp32 index; replace those too.
+        if (faiss_index is None or faiss_index.ntotal > len(embeddings)
+                or not hasattr(faiss_index, 'hnsw')):
+            faiss_index = build_faiss_index(embeddings)
+        elif faiss_index.ntotal == len(embeddings):
+            return
+        else:
+            _add_to_faiss_index(faiss_index, embeddings[faiss_index.ntotal:])
+        _save_faiss_index(faiss_index, data_dir)
+    except Exception as e:
+        print(json.dumps({"error": f"Failed to update FAISS index: {str(e)}"}))
+
+def top_k_indices(similarities, top_k):
+    """
+    Indices of the top_k largest similarities, best first, in O(N + k log k).
+    """
+    top_k = min(top_k, len(similarities))
+    if top_k <= 0:
+        return np.empty(0, dtype=np.intp)
+    indices = np.argpartition(-similarities, top_k - 1)[:top_k]
+    return indices[np.argsort(-similarities[indices])]
+
+def search_embeddings(query_embedding, embeddings, top_k, faiss_index=None):
+    """
+    Return (indices, similarities) of the top_k matches for a unit-normalized query, best first.
+    Uses the FAISS index when given, otherwise a brute-force matvec over the stored
+    (possibly int8) embeddings.
+    """
+    if faiss_index is not None:
+        if hasattr(faiss_index, 'hnsw'):
+            # Only ever raised, since a cached index may be shared by concurrent queries
+            faiss_index.hnsw.efSearch = max(faiss_index.hnsw.efSearch, 64, top_k)
+        query = np.ascontiguousarray(query_embedding, dtype=np.float32).reshape(1, -1)
+        similarities, indices = faiss_index.search(query, top_k)
+        found = indices[0] >= 0
+        return indices[0][found], similarities[0][found]
+    
+    # Stored embeddings are unit-normalized, so cosine similarity is a matvec; dequantize
+    # in fixed-size row blocks so peak memory stays near the size of the int8 matrix
+    query = np.asarray(query_embedding, dtype=np.float32)
+    if embeddings.dtype == np.int8:
+        # Fold the int8 scale into the query instead of rescaling every row
+        query = query * np.float32(1.0 / QUANTIZATION_SCALE)
+    similarities = np.empty(len(embeddings), dtype=np.float32)
+    for start in range(0, len(embeddings), SEARCH_BLOCK_ROWS):
+        block = embeddings[start:start + SEARCH_BLOCK_ROWS]
+        similarities[start:start + len(block)] = block.astype(np.float32, copy=False) @ query
+    indices = top_k_indices(similarities, top_k)
+    return indices, similarities[indices]
+
+def search_images(query_embedding, embeddings, image_paths, top_k, faiss_index=None, is_tile=None):
+    """
+    Return [{"path", "similarity"}] for the top_k images, best first.
+    When the index has tile rows, each image is scored by its best row (whole image or tile).
+    """
+    tiled = is_tile is not None and bool(is_tile.any())
+    # Over-fetch so top_k distinct images survive even when every tile of an image matches
+    fetch = top_k * (MAX_TILES_PER_IMAGE + 1) if tiled else top_k
+    indices, similarities = search_embeddings(query_embedding, embeddings, fetch, faiss_index)
+    
+    results = []
+    seen = set()
+    for idx, similarity in zip(indices, similarities):
+        path = image_paths[idx]
+        if tiled:
+            # Tiles share their source image's path, so keep only its first (best) row
+            if path in seen:
+                continue
+            seen.add(path)
+        results.append({
+            "path": path,
+            "similarity": float(similarity)
+        })
+        if len(results) == top_k:
+            break
+    return results
+
+def semantic_search(query_embedding, embeddings, image_paths, top_k=5, faiss_index=None, is_tile=None):
     if query_embedding is None or embeddings is None or image_paths is None:
         print(json.dumps({"error": "Missing data for search"}))
         return None
         
     try:
-        similarities = cosine_similarity([query_embedding], embeddings)[0]
-        sorted_indices = np.argsort(similarities)[::-1]
-        
-        results = []
-        for idx in sorted_indices[:top_k]:
-            results.append({
-                "path": image_paths[idx],
-                "similarity": float(similarities[idx])
-            })
-            
+        query_embedding = np.asarray(query_embedding, dtype=np.float32)
+        query_embedding = query_embedding / np.linalg.norm(query_embedding)
+        results = search_images(query_embedding, embeddings, image_paths, top_k, faiss_index, is_tile)
         print(json.dumps(results))
         return results
     except Exception as e:
@@ -86,7 +408,7 @@ def main():
         print(json.dumps({"error": f"Failed to create directory: {str(e)}"}))
         return
         
-    embeddings, image_paths = load_embeddings(data_dir)
+    embeddings, image_paths, is_tile = load_embeddings(data_dir)
     if embeddings is None or image_paths is None:
         return
 
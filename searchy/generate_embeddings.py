@@ -1,119 +1,335 @@
 import torch
-from PIL import Image
+from PIL import Image, features
 import os
-import pickle
 import numpy as np
-from tqdm import tqdm
-from transformers import CLIPProcessor, CLIPModel
 import sys
 import json
+import math
+from concurrent.futures import ThreadPoolExecutor
+import torch.multiprocessing as mp
+from torch.utils.data import Dataset, DataLoader
+from torchvision import transforms as T
+from similarity_search import get_model_and_processor, get_device
+from embedding_utils import (MAX_TILES_PER_IMAGE, append_embeddings, dequantize_embeddings, index_exists,
+                             is_appendable, load_index, load_index_settings, save_embeddings,
+                             save_index_settings, update_faiss_index)
 
-def process_images(image_dir, output_dir):
+BATCH_SIZE = 32
+NUM_WORKERS = min(4, os.cpu_count() or 1)
+# CPU-only indexing shards large runs across processes; below this spawn cost dominates
+NUM_INDEX_PROCESSES = max(1, min(4, (os.cpu_count() or 1) // 2))
+PARALLEL_MIN_IMAGES = 256
+# torch.compile takes tens of seconds up front; only worth it for CUDA runs of at least this many batches
+COMPILE_MIN_BATCHES = 16
+# CLIP ViT-B/32 resizes the shortest edge to 224 before center-cropping
+MIN_DECODE_EDGE = 224
+# Icons and thumbnails below this give near-meaningless embeddings
+MIN_IMAGE_PIXELS = 64 * 64
+# Modes Image.reduce() accepts directly; palette/bilevel images are converted first
+REDUCIBLE_MODES = ('RGB', 'RGBA', 'L', 'LA', 'CMYK', 'I', 'F')
+# With tiling enabled, images above this size also get one embedding per tile
+TILE_THRESHOLD_PX = 1_200_000
+
+def build_image_transform(processor):
+    """
+    Equivalent of the CLIP image processor as a torchvision pipeline, which skips
+    the HF processor's per-call PIL -> NumPy -> torch round trips.
+    """
+    image_processor = processor.image_processor
+    crop_size = image_processor.crop_size
+    return T.Compose([
+        T.Resize(image_processor.size["shortest_edge"], interpolation=T.InterpolationMode.BICUBIC),
+        T.CenterCrop((crop_size["height"], crop_size["width"])),
+        T.ToTensor(),
+        T.Normalize(image_processor.image_mean, image_processor.image_std),
+    ])
+
+def open_image(img_path):
+    """
+    Open an image lazily, rejecting broken files and tiny images before any
+    pixel data is decoded.
+    """
+    # Image.open only parses the header, so size is known before verify() reads the whole file
+    with Image.open(img_path) as image:
+        if image.size[0] * image.size[1] < MIN_IMAGE_PIXELS:
+            raise ValueError(f"image too small ({image.size[0]}x{image.size[1]})")
+        image.verify()
+    # verify() consumes the file handle, so the image has to be reopened afterwards
+    return Image.open(img_path)
+
+def decode_image(image, min_width=MIN_DECODE_EDGE, min_height=MIN_DECODE_EDGE):
+    """
+    Decode an opened image no larger than needed to stay at least min_width x min_height.
+    JPEGs are downscaled inside libjpeg via draft(); other formats are box-reduced
+    in their native mode by an integer factor, before any RGB conversion.
+    """
+    if image.format == 'JPEG':
+        image.draft('RGB', (min_width, min_height))
+    # Downscale before converting so e.g. RGBA screenshots never get a full-size RGB copy
+    factor = min(image.size[0] // min_width, image.size[1] // min_height)
+    if factor >= 2 and image.mode in REDUCIBLE_MODES:
+        image = image.reduce(factor)
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    factor = min(image.size[0] // min_width, image.size[1] // min_height)
+    if factor >= 2:
+        image = image.reduce(factor)
+    return image
+
+def load_image(img_path):
+    """
+    Decode an image no larger than needed for CLIP's 224px input.
+    """
+    return decode_image(open_image(img_path))
+
+def tile_grid(width, height):
+    """
+    (columns, rows) of a near-square tile grid with at most MAX_TILES_PER_IMAGE tiles,
+    or None if the image is too small to be worth tiling.
+    """
+    if width * height < TILE_THRESHOLD_PX:
+        return None
+    columns = min(MAX_TILES_PER_IMAGE, max(1, round(math.sqrt(MAX_TILES_PER_IMAGE * width / height))))
+    rows = max(1, min(MAX_TILES_PER_IMAGE // columns, round(columns * height / width)))
+    if columns * rows == 1:
+        return None
+    return columns, rows
+
+def load_image_tiles(img_path, include_whole_image=True):
+    """
+    Decode an image plus, for large images, a grid of crops so fine detail such as
+    on-screen text survives CLIP's 224px input. Returns a list of images with the
+    whole image first (unless include_whole_image is False), followed by its tiles.
+    """
+    image = open_image(img_path)
+    grid = tile_grid(*image.size)
+    if grid is None:
+        return [decode_image(image)] if include_whole_image else []
+    
+    columns, rows = grid
+    image = decode_image(image, columns * MIN_DECODE_EDGE, rows * MIN_DECODE_EDGE)
+    width, height = image.size
+    images = [image] if include_whole_image else []
+    for row in range(rows):
+        for column in range(columns):
+            box = (column * width // columns, row * height // rows,
+                   (column + 1) * width // columns, (row + 1) * height // rows)
+            images.append(image.crop(box))
+    return images
+
+class ImagePathDataset(Dataset):
+    """Decodes and preprocesses images on DataLoader workers so I/O overlaps with inference."""
+    def __init__(self, image_paths, transform, tile_large_images=False, retile_paths=frozenset()):
+        self.image_paths = image_paths
+        self.transform = transform
+        self.tile_large_images = tile_large_images
+        # Already indexed as whole images; only their tiles are missing
+        self.retile_paths = retile_paths
+
+    def __len__(self):
+        return len(self.image_paths)
+
+    def __getitem__(self, idx):
+        img_path = self.image_paths[idx]
+        try:
+            # Each entry is (pixel values, path, is_tile)
+            if img_path in self.retile_paths:
+                return [(self.transform(image), img_path, True)
+                        for image in load_image_tiles(img_path, include_whole_image=False)]
+            if self.tile_large_images:
+                return [(self.transform(image), img_path, i > 0) for i, image in enumerate(load_image_tiles(img_path))]
+            return [(self.transform(load_image(img_path)), img_path, False)]
+        except Exception as e:
+            print(f"Error processing {img_path}: {str(e)}")
+            return []
+
+def collate_images(batch):
+    batch = [entry for entries in batch for entry in entries]
+    if not batch:
+        return None, [], []
+    pixel_values, paths, is_tile = zip(*batch)
+    return torch.stack(pixel_values), list(paths), list(is_tile)
+
+IMAGE_EXTENSIONS = frozenset(('.png', '.jpg', '.jpeg'))
+# Tool and system directories that never hold user images worth indexing
+SKIP_DIRS = frozenset(('.git', '.Trash', '.venv', '__pycache__', 'node_modules'))
+SCAN_WORKERS = 16
+
+def _scan_entries(directory, subdirs, image_paths):
+    # Split one directory's entries into subdirectories to descend into and image files
     try:
-        
-        output_file = os.path.join(output_dir, 'image_index.bin')
-        existing_embeddings = []
-        existing_paths = []
-        if os.path.exists(output_file):
-            print("Loading existing index...")
-            with open(output_file, 'rb') as f:
-                data = pickle.load(f)
-                existing_embeddings = data['embeddings'].tolist()
-                existing_paths = data['image_paths']
-                print(f"Loaded {len(existing_paths)} existing images")
-
-        print("Loading CLIP model...")
-        model = CLIPModel.from_pretrained("openai/clip-vit-base-patch32")
-        processor = CLIPProcessor.from_pretrained("openai/clip-vit-base-patch32")
-        
-        print("Scanning for images...")
-        image_paths = []
-        for root, dirs, files in os.walk(image_dir):
-            for file in files:
-                if file.lower().endswith(('.png', '.jpg', '.jpeg')):
-                    
-                    full_path = os.path.join(root, file)
-                    if full_path not in existing_paths:
-                        image_paths.append(full_path)
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                name = entry.name
+                if entry.is_dir(follow_symlinks=False):
+                    if name in SKIP_DIRS:
+                        print(f"Skipping directory (in SKIP_DIRS): {entry.path}")
                     else:
-                        print(f"Skipping already indexed image: {file}")
-        
-        if not image_paths:
-            print(f"No new images found in {image_dir}")
-            return
-            
-        total_images = len(image_paths)
-        print(f"Found {total_images} new images. Processing...")
-        
-        embeddings = []
-        valid_paths = []
-        
-        for i, img_path in enumerate(image_paths, 1):
-            try:
-                print(f"Processing image {i}/{total_images}: {os.path.basename(img_path)}")
-                image = Image.open(img_path)
-                if image.mode != 'RGB':
-                    image = image.convert('RGB')
-                    
-                
-                inputs = processor(images=image, return_tensors="pt")
-                image_features = model.get_image_features(**inputs)
-                
-                
-                embedding = image_features.detach().numpy()[0]
-                embedding = embedding / np.linalg.norm(embedding)
-                
-                embeddings.append(embedding)
-                valid_paths.append(img_path)
-                print(f"Successfully processed {os.path.basename(img_path)}")
-                
-            except Exception as e:
-                print(f"Error processing {img_path}: {str(e)}")
-                continue
-        
-        if not embeddings:
-            print("No valid images were processed")
-            return
-            
-        
-        all_embeddings = existing_embeddings + embeddings
-        all_paths = existing_paths + valid_paths
-        
-        
-        all_embeddings = np.array(all_embeddings)
-        
-        
-        os.makedirs(output_dir, exist_ok=True)
-        
-        data = {
-            'embeddings': all_embeddings,
-            'image_paths': all_paths
-        }
-        
-        with open(output_file, 'wb') as f:
-            pickle.dump(data, f)
-        
-        print(f"Total images in index: {len(all_paths)}")
-        print(f"New images added: {len(valid_paths)}")
-        print(f"Embeddings shape: {all_embeddings.shape}")
-        print(f"Saved to {output_file}")
-        print("Indexing completed successfully!")
-        
+                        subdirs.append(entry.path)
+                elif os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS:
+                    image_paths.append(entry.path)
+    except OSError as e:
+        print(f"Error scanning {directory}: {str(e)}")
+
+def _scan_tree(root):
+    image_paths = []
+    pending = [root]
+    while pending:
+        _scan_entries(pending.pop(), pending, image_paths)
+    return image_paths
+
+def scan_image_files(image_dir):
+    """
+    Recursively list image file paths under image_dir, sorted, using os.scandir,
+    which reuses the file type from the directory read instead of a stat per entry.
+    Top-level subdirectories are walked concurrently to hide per-directory
+    syscall latency on network and cold-cache volumes.
+    """
+    subdirs = []
+    image_paths = []
+    _scan_entries(image_dir, subdirs, image_paths)
+    with ThreadPoolExecutor(max_workers=SCAN_WORKERS) as executor:
+        for subdir_paths in executor.map(_scan_tree, subdirs):
+            image_paths.extend(subdir_paths)
+    image_paths.sort()
+    return image_paths
+
+def compile_vision_model(model, total_images):
+    """
+    JIT-compile the CLIP vision tower with torch.compile on CUDA for runs large
+    enough to amortize compilation; CPU and MPS runs stay eager.
+    Shapes are static (batches are padded to BATCH_SIZE), so one graph is reused for every batch.
+    The eager module stays reachable via `_orig_mod` as a fallback.
+    """
+    if (not hasattr(torch, "compile") or get_device().type != "cuda"
+            or total_images < COMPILE_MIN_BATCHES * BATCH_SIZE
+            or hasattr(model.vision_model, "_orig_mod")):
+        return model
+    try:
+        model.vision_model = torch.compile(model.vision_model, mode="reduce-overhead", fullgraph=False, dynamic=False)
     except Exception as e:
-        print(f"Failed to process images: {str(e)}")
-        import traceback
-        print(traceback.format_exc())
-
-if __name__ == "__main__":
-    if len(sys.argv) < 2:
-        print("Usage: python generate_embeddings.py <image_directory>")
-        sys.exit(1)
+        print(f"torch.compile unavailable, using eager model: {str(e)}")
+    return model
+
+def encode_pixel_values(model, pixel_values):
+    # Call the vision tower and projection directly, skipping get_image_features' kwargs handling
+    with torch.inference_mode():
+        pooled_output = model.vision_model(pixel_values=pixel_values)[1]
+        image_features = model.visual_projection(pooled_output).float()
+        return torch.nn.functional.normalize(image_features, dim=-1)
+
+_padding = None
+
+def pad_batch(pixel_values):
+    # Zero-pad an under-full batch so the compiled graph never sees a new shape
+    global _padding
+    missing = BATCH_SIZE - len(pixel_values)
+    if missing <= 0:
+        return pixel_values
+    # One full batch of zeros is allocated once per process and sliced for every tail
+    shape = (BATCH_SIZE, *pixel_values.shape[1:])
+    if (_padding is None or _padding.shape != shape
+            or _padding.dtype != pixel_values.dtype or _padding.device != pixel_values.device):
+        _padding = pixel_values.new_zeros(shape)
+    return torch.cat([pixel_values, _padding[:missing]])
+
+def generate_image_embeddings_batch(model, pixel_values):
+    try:
+        batch_len = len(pixel_values)
+        # No-op for batches already prefetched to the GPU
+        pixel_values = pixel_values.to(get_device(), dtype=model.dtype, non_blocking=True)
+        try:
+            if hasattr(model.vision_model, "_orig_mod"):
+                pixel_values = pad_batch(pixel_values)
+            image_features = encode_pixel_values(model, pixel_values)
+        except Exception as e:
+            if not hasattr(model.vision_model, "_orig_mod"):
+                raise
+            # Compilation happens on first call; fall back to eager if it fails
+            print(f"Compiled vision model failed, falling back to eager: {str(e)}")
+            model.vision_model = model.vision_model._orig_mod
+            image_features = encode_pixel_values(model, pixel_values)
         
-    image_dir = sys.argv[1]
-    output_dir = "/Users/ausaf/Library/Application Support/searchy"
+        # Drop the outputs of any padding rows
+        return image_features[:batch_len].cpu().numpy()
+    except Exception as e:
+        print(f"Error processing batch of {len(pixel_values)} images: {str(e)}")
+        return []
+
+def iterate_batches(loader, total_images, log_prefix=""):
+    # Tiles can make a loader batch larger than BATCH_SIZE; keep forward passes at BATCH_SIZE
+    processed = 0
+    for pixel_values, batch_paths, batch_tiles in loader:
+        processed = min(processed + BATCH_SIZE, total_images)
+        print(f"{log_prefix}Processing images {processed}/{total_images}")
+        if pixel_values is None:
+            continue
+        for start in range(0, len(batch_paths), BATCH_SIZE):
+            yield (pixel_values[start:start + BATCH_SIZE], batch_paths[start:start + BATCH_SIZE],
+                   batch_tiles[start:start + BATCH_SIZE])
+
+def prefetch_to_device(batches, dtype):
+    """
+    On CUDA, copy each batch to the GPU on a side stream while the previous batch
+    runs through the model; elsewhere batches pass through unchanged.
+    """
+    device = get_device()
+    if device.type != "cuda":
+        yield from batches
+        return
+    copy_stream = torch.cuda.Stream()
+
+    def ready(pixel_values, copied, batch_paths, batch_tiles):
+        compute_stream = torch.cuda.current_stream()
+        compute_stream.wait_event(copied)
+        # Allocated on the copy stream; keep its memory alive until compute is done with it
+        pixel_values.record_stream(compute_stream)
+        return pixel_values, batch_paths, batch_tiles
+
+    pending = None
+    for pixel_values, batch_paths, batch_tiles in batches:
+        with torch.cuda.stream(copy_stream):
+            pixel_values = pixel_values.to(device, dtype=dtype, non_blocking=True)
+        copied = copy_stream.record_event()
+        # The next copy is already queued when the previous batch is handed over for compute
+        if pending is not None:
+            yield ready(*pending)
+        pending = (pixel_values, copied, batch_paths, batch_tiles)
+    if pending is not None:
+        yield ready(*pending)
+
+def embed_images(model, dataset, num_workers=NUM_WORKERS, log_prefix=""):
+    """
+    Embed an ImagePathDataset in batches; returns (fp16 embeddings, row paths, row is_tile flags)
+    for the rows that embedded successfully.
+    """
+    total_images = len(dataset)
+    # fp16 staging buffer, grown on demand when tiles add extra rows;
+    # embedding_utils quantizes to the on-disk dtype when saving
+    embeddings = np.empty((total_images, model.config.projection_dim), dtype=np.float16)
+    valid_paths = []
+    valid_tiles = []
     
-    if not os.path.exists(image_dir):
-        print(f"Error: Directory '{image_dir}' does not exist")
-        sys.exit(1)
-        
-    process_images(image_dir, output_dir)
+    loader = DataLoader(
+        dataset,
+        batch_size=BATCH_SIZE,
+        num_workers=num_workers,
+        collate_fn=collate_images,
+        # Pinned host batches let the side-stream CUDA copy run asynchronously
+        pin_memory=get_device().type == "cuda",
+    )
+    
+    batches = prefetch_to_device(iterate_batches(loader, total_images, log_prefix), model.dtype)
+    for pixel_values, batch_paths, batch_tiles in batches:
+        batch_embeddings = generate_image_embeddings_batch(model, pixel_values)
+        for img_path, is_tile, embedding in zip(batch_paths, batch_tiles, batch_embeddings):
+            if len(valid_paths) == len(embeddings):
+                embeddings = np.concatenate([embeddings, np.empty_like(embeddings)], axis=0)
+            embeddings[len(valid_paths)] = embedding
+            valid_paths.append(img_path)
+            valid_tiles.append(is_tile)
+            if not is_tile:
+                print(f"{log_prefix}Successfully processed {os.path.basename(img_path)}")
+    
+    return embeddings[:len(valid_paths)], valid_paths, valid_tiles
+
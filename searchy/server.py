@@ -1,6 +1,7 @@
 import os
 import argparse
 import logging
+import threading
 from fastapi import FastAPI, HTTPException
 from pydantic import BaseModel
 from similarity_search import CLIPSearcher
@@ -17,6 +18,16 @@ app = FastAPI()
 searcher = CLIPSearcher()
 
 
+def warmup_searcher():
+    try:
+        searcher.warmup()
+    except Exception as e:
+        logger.warning(f"Search warmup failed: {e}")
+
+# Warm up in the background so startup isn't blocked on a forward pass
+threading.Thread(target=warmup_searcher, daemon=True).start()
+
+
 class SearchRequest(BaseModel):
     query: str
     top_k: int
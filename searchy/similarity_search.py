@@ -1,22 +1,49 @@
 import torch
-from PIL import Image
 import os
-import pickle
 import numpy as np
 from transformers import CLIPProcessor, CLIPModel
 import sys
 import json
 import time
+import threading
+from collections import OrderedDict
+from embedding_utils import index_exists, index_version, load_index, load_faiss_index, search_images
 
 
 _model = None
 _processor = None
+_device = None
+
+TEXT_CACHE_SIZE = 1024
+
+def get_device():
+    global _device
+    if _device is None:
+        if torch.cuda.is_available():
+            _device = torch.device("cuda")
+        elif torch.backends.mps.is_available():
+            _device = torch.device("mps")
+        else:
+            _device = torch.device("cpu")
+    return _device
 
 def get_model_and_processor():
     global _model, _processor
     if _model is None or _processor is None:
         print("Loading CLIP model...", file=sys.stderr)
-        _model = CLIPModel.from_pretrained("openai/clip-vit-base-patch32")
+        device = get_device()
+        if device.type == "cpu":
+            torch.set_num_threads(max(1, (os.cpu_count() or 2) // 2))
+            try:
+                torch.set_num_interop_threads(2)
+            except RuntimeError:
+                # Can only be set before any inter-op parallel work has started
+                pass
+        _model = CLIPModel.from_pretrained("openai/clip-vit-base-patch32").to(device)
+        # Half precision roughly doubles ViT throughput on GPU/MPS; CPU stays in fp32
+        if device.type in ("cuda", "mps"):
+            _model = _model.half()
+        _model.eval()
         _processor = CLIPProcessor.from_pretrained("openai/clip-vit-base-patch32")
     return _model, _processor
 
@@ -24,31 +51,67 @@ def get_model_and_processor():
 
 class CLIPSearcher:
     def __init__(self):
-        self.model, self.processor = get_model_and_processor()  
+        self.model, self.processor = get_model_and_processor()
+        self.device = get_device()
+        self._text_cache = OrderedDict()
+        self._text_cache_lock = threading.Lock()
+        self._index = None
+        self._index_version = None
+        self._index_lock = threading.Lock()
 
 
+    def warmup(self):
+        """
+        Run one throwaway text forward pass so the first real query doesn't pay
+        for lazy kernel selection and allocator warm-up.
+        """
+        self._encode_text("")
+
     def generate_text_embedding(self, text):
+        # Interactive search repeats queries often; serve repeats from an LRU cache
+        with self._text_cache_lock:
+            cached = self._text_cache.get(text)
+            if cached is not None:
+                self._text_cache.move_to_end(text)
+                return cached.copy()
+        
+        embedding = self._encode_text(text)
+        with self._text_cache_lock:
+            self._text_cache[text] = embedding
+            if len(self._text_cache) > TEXT_CACHE_SIZE:
+                self._text_cache.popitem(last=False)
+        return embedding.copy()
+
+    def _encode_text(self, text):
         inputs = self.processor(text=text, return_tensors="pt", padding=True)
-        text_features = self.model.get_text_features(**inputs)
-        embedding = text_features.detach().numpy()[0]
+        inputs = {k: v.to(self.device) for k, v in inputs.items()}
+        with torch.inference_mode():
+            text_features = self.model.get_text_features(**inputs)
+        embedding = text_features.float().cpu().numpy()[0]
         return embedding / np.linalg.norm(embedding)
 
+    def load_index(self, data_dir):
+        """
+        Return (embeddings, image_paths, is_tile, faiss_index), reusing the last load
+        until the index files change on disk.
+        """
+        version = index_version(data_dir)
+        with self._index_lock:
+            if self._index is None or self._index_version != version:
+                embeddings, image_paths, is_tile = load_index(data_dir)
+                faiss_index = load_faiss_index(data_dir, len(embeddings))
+                self._index = (embeddings, image_paths, is_tile, faiss_index)
+                self._index_version = version
+            return self._index
+
     def search(self, query, data_dir, top_k=5):
         try:
             start_time = time.time()
             
-            filename = os.path.join(data_dir, 'image_index.bin')
-            if not os.path.exists(filename):
+            if not index_exists(data_dir):
                 return print(json.dumps({"error": "No image index found"}))
 
-            with open(filename, 'rb') as f:
-                data = pickle.load(f)
-                
-            if not isinstance(data, dict) or 'embeddings' not in data or 'image_paths' not in data:
-                return print(json.dumps({"error": "Invalid data format"}))
-                
-            embeddings = data['embeddings']
-            image_paths = data['image_paths']
+            embeddings, image_paths, is_tile, faiss_index = self.load_index(data_dir)
             
             if len(embeddings) == 0:
                 return print(json.dumps({"error": "No images indexed"}))
@@ -56,15 +119,7 @@ class CLIPSearcher:
             print(f"Loaded {len(embeddings)} embeddings", file=sys.stderr)
             query_embedding = self.generate_text_embedding(query)
             
-            similarities = embeddings @ query_embedding
-            sorted_indices = np.argsort(similarities)[::-1]
-            
-            results = []
-            for idx in sorted_indices[:top_k]:
-                results.append({
-                    "path": image_paths[idx],
-                    "similarity": float(similarities[idx])
-                })
+            results = search_images(query_embedding, embeddings, image_paths, top_k, faiss_index, is_tile)
             
             total_time = time.time() - start_time
             final_output = {
@@ -84,8 +139,6 @@ class CLIPSearcher:
             return None
 
 
-_searcher = CLIPSearcher()
-
 def main():
     if len(sys.argv) < 4:
         print(json.dumps({"error": "Missing arguments"}))
@@ -95,7 +148,7 @@ def main():
     top_k = int(sys.argv[2])
     data_dir = sys.argv[3]
     
-    _searcher.search(query, data_dir, top_k)
+    CLIPSearcher().search(query, data_dir, top_k)
 
 if __name__ == "__main__":
     main()